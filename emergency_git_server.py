@@ -72,7 +72,7 @@
 Notes
 -----
 
-This is a minimal, synchronous Git HTTP server for quick chores, local
+This is a minimal, threaded Git HTTP server for quick chores, local
 experiments, and Git tutorials. Production use should not be attempted, even
 even when isolated from the open web. Opt instead for a pro-quality "app,"
 many of which are only a ``docker-run`` away.
@@ -97,19 +97,60 @@ from __future__ import absolute_import
 
 import os
 import sys
+import hmac
 import json
+import base64
 import select
-
+import hashlib
+import binascii
+import warnings
+import posixpath
+import traceback
+
+from io import BytesIO
+from shutil import copyfileobj
+from tempfile import TemporaryFile
 from subprocess import check_output, Popen, PIPE, CalledProcessError
 
 if sys.version_info < (3, 0):
     import httplib as HTTPStatus
-    from future_builtins import filter
     from CGIHTTPServer import CGIHTTPRequestHandler
     from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from time import time as monotonic
+    from urllib import unquote, unquote_plus
+    from base64 import b64decode as b64decode_strict  # no validate kwarg
 else:
     from http import HTTPStatus
     from http.server import CGIHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from time import monotonic
+    from urllib.parse import unquote, unquote_plus
+
+    def b64decode_strict(s):
+        return base64.b64decode(s, validate=True)
+
+try:
+    from subprocess import DEVNULL
+except ImportError:  # 27
+    DEVNULL = open(os.devnull, "rb")
+
+try:
+    from types import MappingProxyType
+except ImportError:  # 27
+    MappingProxyType = dict
+
+try:
+    import ssl
+except ImportError:  # Python built without OpenSSL
+    ssl = None
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)  # 3.11+
+        import crypt
+except ImportError:  # Windows, 3.13+
+    crypt = None
 
 __version__ = "0.1"
 
@@ -128,8 +169,21 @@ config = {
 }
 
 
+_libexec_dir = None
+
+
 def get_libexec_dir():
-    """Return path to dir containing Git plumbing exes"""
+    """Return path to dir containing Git plumbing exes
+
+    Only the first call spawns git; later ones reuse the answer.
+    """
+    global _libexec_dir
+    if _libexec_dir is None:
+        _libexec_dir = _find_libexec_dir()
+    return _libexec_dir
+
+
+def _find_libexec_dir():
     out_path = None
     #
     try:
@@ -148,17 +202,101 @@ def get_libexec_dir():
     return out_path
 
 
+# Maps (authfile, (mtime, size)) -> parsed dict, see get_auth_dict
+_auth_dicts = {}
+
+
 def get_auth_dict(authfile):
+    """Return parsed AUTHFILE, either a path to a json file or json text
+
+    Files are only reread when their mtime or size changes.
+    """
     if authfile is None:
         return {}
     if os.path.exists(authfile):
-        with open(authfile) as f:
-            outdict = json.load(f)
+        st = os.stat(authfile)
+        key = (authfile, (st.st_mtime, st.st_size))
     else:
-        outdict = json.loads(authfile)
+        key = (authfile, None)
+    outdict = _auth_dicts.get(key)
+    if outdict is None:
+        if key[1] is None:
+            outdict = json.loads(authfile)
+        else:
+            with open(authfile) as f:
+                outdict = json.load(f)
+        _auth_dicts.clear()
+        _auth_dicts[key] = outdict
     return outdict
 
 
+def build_auth_trie(auth_dict):
+    """Return nested dicts of path components from auth_dict's keys
+
+    The realm info for a protected path is stored under the ``None`` key
+    of the node for its last component.
+    """
+    trie = {}
+    for restricted_path, realm_info in auth_dict.items():
+        node = trie
+        for part in restricted_path.split("/"):
+            if part:
+                node = node.setdefault(part, {})
+        node[None] = realm_info
+    return trie
+
+
+def find_realm(auth_trie, path):
+    """Return realm info for the longest protected prefix of path or None"""
+    node = auth_trie
+    found = node.get(None)
+    for part in path.split("/"):
+        if not part:
+            continue
+        node = node.get(part)
+        if node is None:
+            break
+        found = node.get(None, found)
+    return found
+
+
+class BoundedCache(dict):
+    """Memo dict that empties itself when full
+
+    Values are stored with an expiry when ``ttl`` (seconds) is given; use
+    ``lookup()`` and ``store()`` rather than item access. Clearing
+    wholesale instead of tracking recency keeps both operations cheap,
+    and the working sets here (paths, repos, logins) are small anyway.
+    """
+
+    _missing = object()
+
+    def __init__(self, maxsize, ttl=None):
+        super(BoundedCache, self).__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+    def lookup(self, key, default=None):
+        entry = self.get(key, self._missing)
+        if entry is self._missing:
+            return default
+        value, expiry = entry
+        if expiry is not None and monotonic() >= expiry:
+            return default
+        return value
+
+    def store(self, key, value):
+        if len(self) >= self.maxsize:
+            self.clear()
+        expiry = None if self.ttl is None else monotonic() + self.ttl
+        self[key] = (value, expiry)
+        return value
+
+
+# Maps uripath -> url_collapse_path(uripath)
+_collapsed_paths = BoundedCache(maxsize=1024)
+
+
 def url_collapse_path(uripath):
     """Mimic standard lib's _url_collapse_path() but return a tuple
 
@@ -170,13 +308,18 @@ def url_collapse_path(uripath):
     slashes for slug-only paths (leafs), even when they start with a slash, so
     "/foo.git" and "foo.git" both become "//foo.git".
 
+    Results are memoized since every request collapses the same path
+    several times (auth, env vars, translation).
+
     """
-    import posixpath
-    try:
-        from urllib.parse import unquote
-    except ImportError:
-        from urllib import unquote
+    result = _collapsed_paths.lookup(uripath)
+    if result is None:
+        result = _collapsed_paths.store(uripath, _collapse_path(uripath))
+    return result
 
+
+def _collapse_path(uripath):
+    """Uncached worker for url_collapse_path"""
     # No catch, *all, destructuring in py27
     path, sep, rest = uripath.partition('?')
     if not any((sep, rest)):
@@ -217,13 +360,23 @@ def translate_path(basedir, uripath):
     return path
 
 
+# Maps abspath -> is_repo(abspath), briefly
+_repo_probes = BoundedCache(maxsize=4096, ttl=2.0)
+
+
 def is_repo(abspath):
-    """Predicate returning true if abspath is a GITDIR"""
-    if os.path.isfile(os.path.join(abspath, "HEAD")) or os.path.isdir(
-        os.path.join(abspath, "refs", "heads")
-    ):
-        return True
-    return False
+    """Predicate returning true if abspath is a GITDIR
+
+    Answers are remembered for a couple seconds because a single clone or
+    push probes the same handful of dirs over and over.
+    """
+    result = _repo_probes.lookup(abspath)
+    if result is None:
+        result = os.path.isfile(
+            os.path.join(abspath, "HEAD")
+        ) or os.path.isdir(os.path.join(abspath, "refs", "heads"))
+        _repo_probes.store(abspath, result)
+    return result
 
 
 def dismember_target(docroot, target):
@@ -246,19 +399,19 @@ def dismember_target(docroot, target):
     gr = []
     ns = []
     path, _, query = url_collapse_path(target)
-    rest = iter(path.split("/"))
-    for part in rest:
-        if not part:
-            continue
-        sofar = os.path.join(docroot, *gr)
-        maybe = os.path.join(sofar, part)  # 27 can't do: *foo, bar
+    parts = [p for p in path.split("/") if p]
+    sofar = docroot
+    for index, part in enumerate(parts):
+        maybe = os.path.join(sofar, part)
+        # Ask (cached) is_repo first; a hit implies maybe exists
+        if is_repo(maybe):
+            repoplus = "/".join(parts[index:])
+            break
         if not os.path.exists(maybe):  # skip phantom ns components
             ns.append(part)
             continue
-        if is_repo(maybe):
-            repoplus = "/".join([part] + list(rest))
-            break
         gr.append(part)
+        sofar = maybe
     else:
         raise RuntimeError("Git repository not found")
     return "/".join(gr), "/".join(ns), repoplus, query
@@ -281,9 +434,8 @@ def determine_env_vars(docroot, verb, target, **config):
     )
 
     env = {}
-    env["GIT_PROJECT_ROOT"] = (
-        os.path.join(docroot, gitroot) if gitroot else docroot
-    )
+    # Components are already collapsed and slash-free at both ends
+    env["GIT_PROJECT_ROOT"] = docroot + "/" + gitroot if gitroot else docroot
 
     if verb == "GET":
         qmark, query = query[0], query[1:]
@@ -298,35 +450,49 @@ def determine_env_vars(docroot, verb, target, **config):
         assert exename == "git-receive-pack" or exename == "git-upload-pack"
     assert repo.endswith(".git"), locals()
 
-    env["PATH_INFO"] = "/".join(("", repoplus))
+    env["PATH_INFO"] = "/" + repoplus
 
     if config.get("USE_NAMESPACES") is True:
         if namespace:  # leave this as nested block
             env["GIT_NAMESPACE"] = namespace
 
-    env["PATH_TRANSLATED"] = "/".join(
-        (env["GIT_PROJECT_ROOT"], env["PATH_INFO"].lstrip("/"))
-    )
+    env["PATH_TRANSLATED"] = env["GIT_PROJECT_ROOT"] + env["PATH_INFO"]
     if os.path.sep == "/":
         assert os.path.exists(os.path.dirname(env["PATH_TRANSLATED"]))
 
     return env
 
 
+_ghb_get_tails = (
+    "/info/refs?service=git-upload-pack",
+    "/info/refs?service=git-receive-pack",
+)
+_ghb_post_tails = ("git-upload-pack", "git-receive-pack")
+
+
 def is_ghb_bound(command, path):
     """Return whether path is destined for git-http-backend"""
 
     if command == "GET":
-        tails = (
-            "/info/refs?service=git-upload-pack",
-            "/info/refs?service=git-receive-pack",
-        )
-        return any(path.endswith(t) for t in tails)
+        return path.endswith(_ghb_get_tails)
 
     assert command == "POST"
-    return any(
-        path.endswith(t) for t in ("git-upload-pack", "git-receive-pack")
-    )
+    return path.endswith(_ghb_post_tails)
+
+
+def is_empty_dir(abspath):
+    """Return True if directory abspath has no entries
+
+    Stops at the first entry rather than listing everything.
+    """
+    if not hasattr(os, "scandir"):  # 27
+        return not os.listdir(abspath)
+    entries = os.scandir(abspath)
+    try:
+        return next(entries, None) is None
+    finally:
+        if hasattr(entries, "close"):  # 35
+            entries.close()
 
 
 def create_repo_from_uri(abspath):
@@ -348,46 +514,112 @@ def create_repo_from_uri(abspath):
                 raise
     # See notes on evolving meaning of os.makedirs kwarg exist_ok
     # https://docs.python.org/3.8/library/os.html#os.makedirs
-    if len(os.listdir(abspath)) != 0:
+    if not is_empty_dir(abspath):
         raise RuntimeError("Leaf not empty: %s" % abspath)
-    return check_output(("git", "-C", abspath, "init", "--bare"))
+    try:
+        return check_output(("git", "-C", abspath, "init", "--bare"))
+    finally:
+        _repo_probes.clear()
+
+
+def apr1_crypt(password, salt):
+    """Return Apache's MD5-based "$apr1$" hash of password
+
+    Same as ``openssl passwd -apr1 -salt SALT PASSWORD``. Both args must be
+    strings; only the first 8 chars of salt are used.
+    """
+    magic = b"$apr1$"
+    pw = password.encode()
+    salt = salt.encode()[:8]
+
+    alt = hashlib.md5(pw + salt + pw).digest()
+    ctx = pw + magic + salt
+    for left in range(len(pw), 0, -16):
+        ctx += alt[:min(16, left)]
+    bits = len(pw)
+    while bits:
+        ctx += b"\x00" if bits & 1 else pw[:1]
+        bits >>= 1
+    final = hashlib.md5(ctx).digest()
+
+    for n in range(1000):
+        ctx = pw if n & 1 else final
+        if n % 3:
+            ctx += salt
+        if n % 7:
+            ctx += pw
+        ctx += final if n & 1 else pw
+        final = hashlib.md5(ctx).digest()
+
+    itoa64 = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+    final = bytearray(final)  # py27 indexes bytes as str
+    out = []
+    triplets = ((0, 6, 12), (1, 7, 13), (2, 8, 14), (3, 9, 15), (4, 10, 5))
+    for a, b, c in triplets:
+        value = final[a] << 16 | final[b] << 8 | final[c]
+        out += [itoa64[value >> shift & 0x3f] for shift in (0, 6, 12, 18)]
+    out += [itoa64[final[11] >> shift & 0x3f] for shift in (0, 6)]
+    return "".join((magic.decode(), salt.decode(), "$", "".join(out)))
 
 
 def verify_pass(saved, received):
     """Attempt to compare .htpasswd file entry to the sent password
 
-    The only supported formats are unix crypt(3) and sha1. Both args
-    must be strings.
+    The only supported formats are apr1 (Apache MD5), unix crypt(3), and
+    sha1. Both args must be strings.
     """
-    if saved.startswith("$apr1"):
+    if saved.startswith("$apr1$"):
         salt = saved.split("$")[2]
-        # Allow CalledProcessError to propagate
-        args = ["openssl", "passwd", "-apr1", "-salt", salt, received]
-        checked = check_output(args)
-        if checked.decode().strip() == saved:
+        if hmac.compare_digest(apr1_crypt(received, salt), saved):
             return True
     elif saved.startswith("{SHA}"):
-        import base64
-        import hashlib
-
         binpass = saved.partition("{SHA}")[-1].encode()
         binpass = base64.b64decode(binpass)
-        if hashlib.sha1(received.encode()).digest() == binpass:
+        digest = hashlib.sha1(received.encode()).digest()
+        if hmac.compare_digest(digest, binpass):
             return True
     # TODO maybe accept $2b METHOD_BLOWFISH
-    elif len(saved) == 13:
-        import crypt
-
+    elif len(saved) == 13 and crypt is not None:
         if crypt.crypt(received, saved[:2]) == saved:
             return True
     return False
 
 
-class TlsServer(HTTPServer, object):
-    """SSL-aware HTTPServer.
+# Maps secretsfile -> ((mtime, size), user/pass dict), see _load_htpasswd
+_htpasswd_dicts = {}
+
+
+# Maps (saved, keyed digest of attempt) -> verify_pass result, for 5 min
+_verified = BoundedCache(maxsize=1024, ttl=300.0)
+_verified_key = os.urandom(32)
+
+
+def verify_pass_cached(saved, received):
+    """Call verify_pass but remember the outcome for a few minutes
+
+    A clone or push sends the same credentials with every request, and
+    apr1 in particular is slow by design. Cache keys only hold an HMAC of
+    the attempt under a per-process random key, never the password.
+    """
+    attempt = "\0".join((saved, received)).encode()
+    digest = hmac.new(_verified_key, attempt, hashlib.sha256).digest()
+    key = (saved, digest)
+    result = _verified.lookup(key)
+    if result is None:
+        result = _verified.store(key, verify_pass(saved, received))
+    return result
+
+
+class TlsServer(ThreadingMixIn, HTTPServer, object):
+    """SSL-aware, threaded HTTPServer.
 
     This mimics the example given in the docs_.
 
+    Each request is handled in its own (daemon) thread, so a slow clone
+    won't hold up everyone else. TLS handshakes happen in that thread
+    too, bounded by ``handshake_timeout``, so an idle peer can't stall
+    the accept loop.
+
     The only difference is that the default shutdown method relied on here
     calls ``socket._socket.shutdown()`` with ``socket.SHUT_WR`` instead of
     ``socket.SHUT_RDWR``, which seems to trigger FD errors during error
@@ -398,36 +630,35 @@ class TlsServer(HTTPServer, object):
 
     """
 
+    daemon_threads = True
+    handshake_timeout = 10.0
+    cgi_env = None  # filled in by HTTPBackendHandler._get_server_env
+
     def __init__(self, server_address, RequestHandlerClass, ssl_context=None):
         self.ssl_context = ssl_context
         super(TlsServer, self).__init__(
             server_address, RequestHandlerClass, bind_and_activate=True
         )
 
-    def process_request(self, request, client_address):
-        # The Threading and Forking mixins override this function
-        if self.ssl_context:
-            try:
-                rapt = self.ssl_context.wrap_socket(request, server_side=True)
-            except Exception as exc:
-                from ssl import SSLError
-
-                # May mean client hasn't okay'd self-signed certs
-                if isinstance(exc, SSLError):
-                    self.handle_error(request, client_address)
-                    self.shutdown_request(request)
-                    return
-                raise
-            else:
-                request = rapt
-                if (
-                    config["DEBUG"]
-                    and self.RequestHandlerClass.cipher is None
-                ):
-                    self.RequestHandlerClass.cipher = request.cipher()
-        # Assume this runs the BaseServer method, which calls the request
-        # handler and then .shutdown_request()
-        return super(TlsServer, self).process_request(request, client_address)
+    def finish_request(self, request, client_address):
+        # ThreadingMixIn runs this in the worker thread, so a peer that
+        # stalls mid-handshake only ties up its own thread (and only for
+        # ``handshake_timeout`` seconds). An SSLError here, which may mean
+        # the client hasn't okay'd self-signed certs, propagates to the
+        # mixin, which calls .handle_error() and .shutdown_request().
+        if not self.ssl_context:
+            return super(TlsServer, self).finish_request(
+                request, client_address
+            )
+        request.settimeout(self.handshake_timeout)
+        rapt = self.ssl_context.wrap_socket(request, server_side=True)
+        try:
+            rapt.settimeout(None)
+            if config["DEBUG"] and self.RequestHandlerClass.cipher is None:
+                self.RequestHandlerClass.cipher = rapt.cipher()
+            super(TlsServer, self).finish_request(rapt, client_address)
+        finally:
+            self.shutdown_request(rapt)
 
     if not hasattr(HTTPServer, "service_actions"):
         # XXX workaround for the lack of a ``service_actions()`` hook in 2.7's
@@ -444,8 +675,15 @@ class HTTPBackendHandler(CGIHTTPRequestHandler, object):
 
     docroot = None
     auth_dict = None
+    auth_trie = None  # (auth_dict, trie), rebuilt when auth_dict changes
+    base_env = None  # see _get_base_env
+    header_envvars = {
+        "content-type": "CONTENT_TYPE",
+        "content-length": "CONTENT_LENGTH",
+        "referer": "HTTP_REFERER",
+        "user-agent": "HTTP_USER_AGENT",
+    }
     git_exec_path = None
-    has_openssl = None
     cipher = None
 
     def __init__(self, *args, **kwargs):
@@ -481,17 +719,51 @@ class HTTPBackendHandler(CGIHTTPRequestHandler, object):
         """
         if length is None:
             length = int(self.headers.get("content-length"))
-        data = self.rfile.read(length)
+        buf = BytesIO()
+        self.copy_body(buf, length)
         # Bad content-length? (see comment in CGIHTTPRequestHandler.run_cgi)
-        while select.select([self.rfile._sock], [], [], 0)[0]:
-            if not self.rfile._sock.recv(1):
+        # Discard whatever stray bytes are already waiting in one go
+        if select.select([self.connection], [], [], 0)[0]:
+            self.connection.recv(65536)
+        return buf.getvalue()
+
+    def copy_body(self, dest, length):
+        """Copy length bytes of request body from remote to file dest
+
+        The body is moved in chunks, so large pushes never sit in memory.
+        Reads on the unbuffered socket may come up short, hence the loop.
+        Should dest go away (backend exited early), the remainder is
+        still read and discarded. Returns the number of bytes missing.
+        """
+        while length > 0:
+            chunk = self.rfile.read(min(length, 65536))
+            if not chunk:
                 break
-        return data
+            length -= len(chunk)
+            if dest is None:
+                continue
+            try:
+                dest.write(chunk)
+            except (IOError, OSError):  # EPIPE
+                dest = None
+        return length
+
+    def send_spool(self, spool, size):
+        """Send size bytes of file object spool to client, from the top
+
+        Uses ``socket.sendfile``, which avoids copying through user space
+        for plain (non-TLS) connections on Linux.
+        """
+        spool.seek(0)
+        self.wfile.flush()
+        if hasattr(self.connection, "sendfile"):
+            self.connection.sendfile(spool, 0, size)
+        else:  # 27
+            copyfileobj(spool, self.wfile)
 
     def _joined(self, path):
         abspath = translate_path(self.docroot, path)
-        compre = os.path.commonprefix((self.docroot, abspath))
-        assert compre == self.docroot
+        assert abspath.startswith(self.docroot)
         return abspath
 
     def _send_header_only(self, code, message):
@@ -502,7 +774,6 @@ class HTTPBackendHandler(CGIHTTPRequestHandler, object):
             self.flush_headers()
 
     def log_exception(self, msg=None):
-        import traceback
         formatted = traceback.format_exc()
         self.log_error("%s\n%s" % (msg, formatted) if msg else formatted)
 
@@ -539,10 +810,6 @@ class HTTPBackendHandler(CGIHTTPRequestHandler, object):
         if "form" in contype:
             # pointless
             if "urlencoded" in contype:
-                try:
-                    from urllib.parse import unquote_plus
-                except ImportError:
-                    from urllib import unquote_plus
                 request_body = unquote_plus(request_body.decode())
             if "init=1" not in request_body:
                 bail()
@@ -583,23 +850,33 @@ class HTTPBackendHandler(CGIHTTPRequestHandler, object):
         for line in lines:
             if ":" not in line:
                 continue
-            u, p = line.split(":")
-            if p.startswith("$apr1") and self.has_openssl is None:
-                try:
-                    check_output(("openssl", "version"))
-                except (FileNotFoundError, CalledProcessError):
-                    self.log_error("E: required openssl exe not found")
-                    self.has_openssl = False
-                    raise
-                else:
-                    self.has_openssl = True
-            elif p.startswith("$2y"):
+            u, _, p = line.partition(":")
+            p = p.strip()
+            if p.startswith("$2y"):
                 msg = "E: bcrypt support requested but not found"
                 self.log_error(msg)
                 raise RuntimeError(msg)
-            secdict[u.strip()] = p.strip()
+            elif len(p) == 13 and crypt is None:
+                # Keep the entry; verify_pass can't match it, so it's a 401
+                self.log_error(
+                    "E: crypt(3) support requested but not found: %r", u
+                )
+            secdict[u.strip()] = p
         return secdict
 
+    def _load_htpasswd(self, secretsfile):
+        """Return user/pass dict for secretsfile, reparsing only on change"""
+        st = os.stat(secretsfile)
+        stamp = (st.st_mtime, st.st_size)
+        cached = _htpasswd_dicts.get(secretsfile)
+        if cached is None or cached[0] != stamp:
+            # Whole file in one read; only happens when it changes
+            with open(secretsfile, "rb") as f:
+                secretlines = f.read().decode("utf-8").splitlines()
+            cached = (stamp, self._get_htpasswd_info(secretlines))
+            _htpasswd_dicts[secretsfile] = cached
+        return cached[1]
+
     def handle_auth(self):
         """Return True if authorized or False to close connection
 
@@ -622,16 +899,16 @@ class HTTPBackendHandler(CGIHTTPRequestHandler, object):
             raise RuntimeError("Auth options are Linux only")
 
         # For GHB-related requests, this will end with query or fake leaf
-        collapsed_path = "".join(url_collapse_path(self.path))
-
-        for maybe_restricted_path, realm_info in self.auth_dict.items():
-            maybe_restricted_path = maybe_restricted_path.rstrip("/")
-            if (
-                collapsed_path == maybe_restricted_path
-                or collapsed_path.startswith(maybe_restricted_path + "/")
-            ):
-                break
-        else:
+        collapsed = url_collapse_path(self.path)
+        collapsed_path = "".join(collapsed)
+
+        cached = HTTPBackendHandler.auth_trie
+        if cached is None or cached[0] is not self.auth_dict:
+            cached = (self.auth_dict, build_auth_trie(self.auth_dict))
+            HTTPBackendHandler.auth_trie = cached
+
+        realm_info = find_realm(cached[1], collapsed[0])
+        if realm_info is None:
             return True
 
         # Allow fetching from protected GHB-related realms that aren't private
@@ -646,17 +923,14 @@ class HTTPBackendHandler(CGIHTTPRequestHandler, object):
         description = realm_info.get("description", "Basic auth requested")
 
         try:
-            secretsfile = realm_info.get("secretsfile")
-            with open(secretsfile) as f:
-                secretlines = f.readlines()
-            secdict = self._get_htpasswd_info(secretlines)
+            secdict = self._load_htpasswd(realm_info.get("secretsfile"))
         except Exception:
             self.log_exception("E: Problem reading .htpasswd file")
             self.send_error(
                 HTTPStatus.INTERNAL_SERVER_ERROR,
                 "Application error looking up auth",
             )
-            return True
+            return False
 
         authorization = self.headers.get("authorization")
 
@@ -688,17 +962,17 @@ class HTTPBackendHandler(CGIHTTPRequestHandler, object):
             return False
 
         self.auth_env["AUTH_TYPE"] = authtype
-        import base64
-        import binascii
 
         try:
-            authorization = base64.b64decode(authval.encode("ascii"))
-            username, password = authorization.decode("ascii").split(":")
-        except (binascii.Error, UnicodeError):
+            authorization = b64decode_strict(authval.encode("ascii"))
+            decoded = authorization.decode("ascii")
+        except (binascii.Error, TypeError, UnicodeError):  # 27: TypeError
             pass
         else:
             config["DEBUG"] and self.dlog("auth", authorization=authorization)
-            if verify_pass(secdict[username], password):
+            username, sep, password = decoded.partition(":")
+            saved = secdict.get(username) if sep else None
+            if saved and verify_pass_cached(saved, password):
                 self.auth_env["REMOTE_USER"] = username
                 return True
 
@@ -756,15 +1030,62 @@ class HTTPBackendHandler(CGIHTTPRequestHandler, object):
 
         config["DEBUG"] and self.dlog("determine_env_vars()", **result)
 
-        try:
-            from types import MappingProxyType
-        except ImportError:
-            self.git_env = result
-        else:
-            self.git_env = MappingProxyType(result)
+        self.git_env = MappingProxyType(result)
 
         return True
 
+    def _get_base_env(self):
+        """Return env vars shared by all CGI requests in this process
+
+        This is a snapshot of ``os.environ`` overlaid with the fixed
+        meta-variables; it's built on first use and only ever copied.
+        """
+        base_env = type(self).base_env
+        if base_env is not None:
+            return base_env
+        base_env = dict(os.environ)
+        # As required by git-http-backend(1); These never change.
+        base_env.update(
+            GIT_HTTP_EXPORT_ALL="",
+            SCRIPT_NAME="git-http-backend",
+            SERVER_SOFTWARE=self.version_string(),
+            GATEWAY_INTERFACE="CGI/1.1",
+            SERVER_PROTOCOL=self.protocol_version,
+        )
+        # 4.1 says: "an optional meta-variable may be omitted (left unset) if
+        # its value is NULL" (a zero-length string).
+        #
+        # EDIT: upstream includes CONTENT_LENGTH here but it has been removed
+        # below. The RFC says it can be NULL but also says it MUST be set IFF
+        # content exists (meaning unset otherwise). Since we only read what's
+        # reported by the request (and discard the rest), there's no sense in
+        # using a fallback, no?
+        rfcvars = (
+            "QUERY_STRING",
+            "REMOTE_HOST",  # SHOULD (can also be REMOTE_HOST)
+            "HTTP_USER_AGENT",
+            "HTTP_COOKIE",
+            "HTTP_REFERER",
+        )
+        for k in rfcvars:
+            base_env.setdefault(k, "")
+        type(self).base_env = base_env
+        return base_env
+
+    def _get_server_env(self):
+        """Return base env plus vars fixed for the life of self.server
+
+        Stashed on the server instance, as wsgiref does with its
+        ``base_environ``, since name and port belong to the server.
+        """
+        server_env = getattr(self.server, "cgi_env", None)
+        if server_env is None:
+            server_env = self._get_base_env().copy()
+            server_env["SERVER_NAME"] = self.server.server_name
+            server_env["SERVER_PORT"] = str(self.server.server_port)
+            self.server.cgi_env = server_env
+        return server_env
+
     def _populate_envvars(self):
         """Return CGI-related env vars
 
@@ -774,12 +1095,9 @@ class HTTPBackendHandler(CGIHTTPRequestHandler, object):
 
         .. _rfc3875: https://tools.ietf.org/html/rfc3875#section-4.1
         """
-        full_env = dict(os.environ)
+        full_env = self._get_server_env().copy()
 
-        # As required by git-http-backend(1); These never change.
         cgi_env = dict(self.git_env)
-        cgi_env["GIT_HTTP_EXPORT_ALL"] = ""
-
         cgi_env.update(self.auth_env)
         # FIXME previous comment said, "Fallback for when auth isn't used,"
         # but that implies auth is mandatory, which it's not
@@ -788,76 +1106,32 @@ class HTTPBackendHandler(CGIHTTPRequestHandler, object):
 
         # Vanilla from here on down
         always = {
-                "SCRIPT_NAME": "git-http-backend",
-                "SERVER_SOFTWARE": self.version_string(),
-                "SERVER_NAME": self.server.server_name,
-                "GATEWAY_INTERFACE": "CGI/1.1",
-                "SERVER_PROTOCOL": self.protocol_version,
-                "SERVER_PORT": str(self.server.server_port),
                 "REQUEST_METHOD": self.command,
                 "REMOTE_ADDR": self.client_address[0],
             }
         cgi_env.update(always)
 
-        if hasattr(self.headers, "get_content_type"):
-            cgi_env["CONTENT_TYPE"] = self.headers.get(
-                "content-type", self.headers.get_content_type()
-            )
-        else:  # 27
-            cgi_env["CONTENT_TYPE"] = (
-                self.headers.typeheader or self.headers.type
-            )
-
-        length = self.headers.get("content-length")
-        if length:
-            cgi_env["CONTENT_LENGTH"] = length
-
-        referer = self.headers.get("referer")
-        if referer:
-            cgi_env["HTTP_REFERER"] = referer
-
+        # One pass over the header fields; default mirrors get_content_type()
+        cgi_env["CONTENT_TYPE"] = "text/plain"
         accept = []
-        # Actual type is X-<custom>
-        for line in self.headers.getallmatchingheaders("accept"):
-            if line[:1] in "\t\n\r ":
-                accept.append(line.strip())
-            else:
-                accept += accept + line[7:].split(",")
-        cgi_env["HTTP_ACCEPT"] = ",".join(accept)
-
-        ua = self.headers.get("user-agent")
-        if ua:
-            cgi_env["HTTP_USER_AGENT"] = ua
-
-        if hasattr(self.headers, "get_all"):
-            co = filter(None, self.headers.get_all("cookie", []))
-        else:
-            co = filter(None, self.headers.getheaders("cookie"))
-        cookie_str = ", ".join(co)
-        if cookie_str:
-            cgi_env["HTTP_COOKIE"] = cookie_str
+        cookies = []
+        for name, value in self.headers.items():
+            if not value:
+                continue
+            name = name.lower()
+            if name == "accept":
+                accept.extend(a.strip() for a in value.split(","))
+            elif name == "cookie":
+                cookies.append(value)
+            elif name in self.header_envvars:
+                cgi_env[self.header_envvars[name]] = value
+        cgi_env["HTTP_ACCEPT"] = ",".join(filter(None, accept))
+        if cookies:
+            cgi_env["HTTP_COOKIE"] = ", ".join(cookies)
 
         config["DEBUG"] and self.dlog("envvars", **cgi_env)
 
         full_env.update(cgi_env)
-        # 4.1 says: "an optional meta-variable may be omitted (left unset) if
-        # its value is NULL" (a zero-length string).
-        #
-        # EDIT: upstream includes CONTENT_LENGTH here but it has been removed
-        # below. The RFC says it can be NULL but also says it MUST be set IFF
-        # content exists (meaning unset otherwise). Since we only read what's
-        # reported by the request (and discard the rest), there's no sense in
-        # using a fallback, no?
-        rfcvars = (
-            "QUERY_STRING",
-            "REMOTE_HOST",  # SHOULD (can also be REMOTE_HOST)
-            "HTTP_USER_AGENT",
-            "HTTP_COOKIE",
-            "HTTP_REFERER",
-        )
-        for k in rfcvars:
-            full_env.setdefault(k, "")
-
         return full_env
 
     def run_cgi(self):
@@ -892,26 +1166,44 @@ class HTTPBackendHandler(CGIHTTPRequestHandler, object):
         except (TypeError, ValueError):
             nbytes = 0
 
-        backend_input = self.consume_and_exhaust(nbytes) or None
-        if backend_input is None:
-            assert "CONTENT_LENGTH" not in env
-
         cmdline = [os.path.join(self.git_exec_path, "git-http-backend")]
-        proc = Popen(cmdline, stdin=PIPE, stdout=PIPE, stderr=PIPE, env=env)
-        stdout, stderr = proc.communicate(input=backend_input)
-
-        proc.stderr.close()
-        proc.stdout.close()
-
-        # See note in docstring re GnuTLS and Content-Length
-        hdr, _, payload = stdout.partition(b"\r\n\r\n")
-        if self.command == "GET" and b"Content-Length" in hdr:
-            self.log_error("W: 'Content-Length' in header from cgi: %r", hdr)
+        # Both output streams go straight to disk, so the request body can
+        # be fed to stdin as it arrives without risk of a pipe deadlock
+        with TemporaryFile() as spool, TemporaryFile() as errlog:
+            # Bodiless requests (info/refs, etc.) skip the stdin pipe
+            proc = Popen(
+                cmdline, stdin=PIPE if nbytes else DEVNULL,
+                stdout=spool, stderr=errlog, env=env
+            )
+            missing = 0
+            if nbytes:
+                try:
+                    missing = self.copy_body(proc.stdin, nbytes)
+                finally:
+                    try:
+                        proc.stdin.close()
+                    except (IOError, OSError):
+                        pass
+            proc.wait()
+            if missing:
+                self.log_error("E: Request body short by %d bytes", missing)
+            errlog.seek(0)
+            stderr = errlog.read()
+
+            # See note in docstring re GnuTLS and Content-Length
+            size = os.fstat(spool.fileno()).st_size
+            spool.seek(0)
+            hdr, sep, _ = spool.read(65536).partition(b"\r\n\r\n")
+            if self.command == "GET" and b"Content-Length" in hdr:
+                self.log_error(
+                    "W: 'Content-Length' in header from cgi: %r", hdr
+                )
 
-        self.send_header("Content-Length", len(payload))
-        if hasattr(self, "flush_headers"):
-            self.flush_headers()
-        self.wfile.write(stdout)
+            payload_size = size - len(hdr) - len(sep) if sep else 0
+            self.send_header("Content-Length", payload_size)
+            if hasattr(self, "flush_headers"):
+                self.flush_headers()
+            self.send_spool(spool, size)
 
         assert proc.returncode is not None  # possible w. concurrent variants
         status = proc.returncode
@@ -1042,8 +1334,9 @@ def set_ssl_context(certfile=None, keyfile=None, dhparams=None):
                     )
             if msg:
                 raise RuntimeError(msg)
-    import ssl
 
+    if ssl is None:
+        raise RuntimeError("TLS requested but Python lacks ssl support")
     context = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
     # Like ``SSLContext.set_default_verify_paths()``, ``set_ecdh_curve()``
     # doesn't exist in 3.5.x, at least not on Fedora's system python3.
@@ -1055,6 +1348,11 @@ def set_ssl_context(certfile=None, keyfile=None, dhparams=None):
     # XXX probably best not to mess with these...
     # context.set_ciphers("EECDH+AESGCM:EDH+AESGCM:AES256+EECDH:AES256+EDH")
     context.load_cert_chain(certfile, keyfile)
+    # Session tickets and the server-side session cache are on by default,
+    # so returning clients (Git opens several connections per fetch) can
+    # resume rather than redo full handshakes. Just settle ALPN up front.
+    if getattr(ssl, "HAS_ALPN", False):
+        context.set_alpn_protocols(["http/1.1"])
     return context
 
 
@@ -1,3 +1,4 @@
+import sys
 import pytest
 from conftest import is_27
 
@@ -46,6 +47,9 @@ def test_set_ssl_context(tmpdir):
         m_cdc.return_value = context
         assert set_ssl_context(certfile.strpath, None, None)
         context.load_cert_chain.assert_called_with(certfile.strpath, None)
+        import ssl
+        if getattr(ssl, "HAS_ALPN", False):
+            context.set_alpn_protocols.assert_called_with(["http/1.1"])
 
         assert set_ssl_context(certfile.strpath, None, dhpfile.strpath)
         context.load_dh_params.assert_called_with(dhpfile.strpath)
@@ -268,3 +272,358 @@ def test__setup_logfile(tmpdir):
     assert "localhost " in result
     assert "42" in result
     assert "service_actions" not in TlsServer.__dict__
+
+
+def test_tls_server_threaded():
+    import socket
+    import threading
+    from emergency_git_server import TlsServer
+
+    try:
+        from SocketServer import BaseRequestHandler
+    except ImportError:
+        from socketserver import BaseRequestHandler
+
+    gate = threading.Event()
+
+    class Handler(BaseRequestHandler):
+        def handle(self):
+            if self.request.recv(1) == b"w":
+                gate.wait(5)
+            self.request.sendall(b"k")
+
+    server = TlsServer(("localhost", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        waiter = socket.create_connection(server.server_address)
+        waiter.sendall(b"w")
+        other = socket.create_connection(server.server_address)
+        other.settimeout(2)
+        other.sendall(b"x")
+        # Would time out were requests handled one at a time
+        assert other.recv(1) == b"k"
+        gate.set()
+        assert waiter.recv(1) == b"k"
+        other.close()
+        waiter.close()
+    finally:
+        gate.set()
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.skipif(is_27, reason="Needs SSLContext.wrap_socket")
+def test_tls_server_stalled_handshake(tmpdir):
+    import ssl
+    import socket
+    import threading
+    import subprocess
+    from emergency_git_server import TlsServer
+    from socketserver import BaseRequestHandler
+
+    certfile = tmpdir.join("cert.pem")
+    keyfile = tmpdir.join("key.pem")
+    try:
+        subprocess.check_call(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+             "-keyout", keyfile.strpath, "-out", certfile.strpath,
+             "-days", "1", "-subj", "/CN=localhost"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip("openssl unavailable")
+
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(certfile.strpath, keyfile.strpath)
+    client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+
+    class Handler(BaseRequestHandler):
+        def handle(self):
+            self.request.recv(1)
+            self.request.sendall(b"k")
+
+    server = TlsServer(("localhost", 0), Handler, server_context)
+    server.handshake_timeout = 1.0
+    errored = threading.Event()
+    server.handle_error = Mock(side_effect=lambda *args: errored.set())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    # Never sends a ClientHello
+    stalled = socket.create_connection(server.server_address)
+    stalled.settimeout(5)
+    try:
+        raw = socket.create_connection(server.server_address, timeout=2)
+        # Would time out were handshakes done in the accept loop
+        other = client_context.wrap_socket(raw)
+        other.sendall(b"x")
+        assert other.recv(1) == b"k"
+        other.close()
+        # Stalled peer eventually gets hung up on (socket is closed before
+        # the failure reaches handle_error, hence the event)
+        assert stalled.recv(1) == b""
+        assert errored.wait(2)
+    finally:
+        stalled.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_verify_pass():
+    from emergency_git_server import apr1_crypt, verify_pass
+
+    # openssl passwd -apr1 -salt Zq3./xY ...
+    known = {
+        "secret": "$apr1$Zq3./xY$VexVSnzeojXGGlIyg4QWn/",
+        "x": "$apr1$Zq3./xY$fWLQp.GDoZ2ZKMqaC6BlC/",
+        "a much longer passphrase, over sixteen bytes":
+            "$apr1$Zq3./xY$dH3/NQumGhFO92DLO1Xo90",
+    }
+    for password, saved in known.items():
+        assert apr1_crypt(password, "Zq3./xY") == saved
+        assert verify_pass(saved, password) is True
+        assert verify_pass(saved, password + "!") is False
+
+    sha = "{SHA}5en6G6MezRroT3XKqkdPOmY/BfQ="
+    assert verify_pass(sha, "secret") is True
+    assert verify_pass(sha, "Secret") is False
+
+
+def test_get_auth_dict(tmpdir):
+    import os
+    import json
+    from emergency_git_server import get_auth_dict
+
+    assert get_auth_dict(None) == {}
+    assert get_auth_dict('{"/foo": {}}') == {"/foo": {}}
+
+    authfile = tmpdir / "auth.json"
+    authfile.write(json.dumps({"/foo": {}}))
+    first = get_auth_dict(authfile.strpath)
+    assert first == {"/foo": {}}
+    assert get_auth_dict(authfile.strpath) is first
+
+    authfile.write(json.dumps({"/bar": {}}))
+    mtime = os.stat(authfile.strpath).st_mtime
+    os.utime(authfile.strpath, (mtime + 5, mtime + 5))
+    assert get_auth_dict(authfile.strpath) == {"/bar": {}}
+
+    # Same mtime but different size (coarse timestamps)
+    authfile.write(json.dumps({"/bar": {}, "/baz": {}}))
+    os.utime(authfile.strpath, (mtime + 5, mtime + 5))
+    assert get_auth_dict(authfile.strpath) == {"/bar": {}, "/baz": {}}
+
+
+def test_find_realm():
+    from emergency_git_server import build_auth_trie, find_realm
+
+    auth_dict = {
+        "/priv": {"description": "outer"},
+        "/priv/team/": {"description": "inner"},
+        "/other/repo.git": {"description": "repo"},
+    }
+    trie = build_auth_trie(auth_dict)
+
+    def desc(path):
+        realm = find_realm(trie, path)
+        return realm and realm["description"]
+
+    assert desc("/") is None
+    assert desc("/privates/foo.git") is None
+    assert desc("/priv") == "outer"
+    assert desc("/priv/foo.git/info/refs") == "outer"
+    assert desc("/priv/team") == "inner"
+    assert desc("/priv/team/foo.git/git-receive-pack") == "inner"
+    assert desc("/other") is None
+    assert desc("/other/repo.git/git-upload-pack") == "repo"
+
+    assert find_realm(build_auth_trie({"/": {}}), "/foo") == {}
+
+
+def test_load_htpasswd(tmpdir):
+    import os
+    from emergency_git_server import HTTPBackendHandler
+
+    handler = HTTPBackendHandler.__new__(HTTPBackendHandler)
+    secretsfile = tmpdir / ".htpasswd"
+    secretsfile.write("alice:{SHA}5en6G6MezRroT3XKqkdPOmY/BfQ=\n")
+
+    first = handler._load_htpasswd(secretsfile.strpath)
+    assert first == {"alice": "{SHA}5en6G6MezRroT3XKqkdPOmY/BfQ="}
+    assert handler._load_htpasswd(secretsfile.strpath) is first
+
+    secretsfile.write("bob:{SHA}5en6G6MezRroT3XKqkdPOmY/BfQ=\n")
+    mtime = os.stat(secretsfile.strpath).st_mtime
+    os.utime(secretsfile.strpath, (mtime + 5, mtime + 5))
+    assert list(handler._load_htpasswd(secretsfile.strpath)) == ["bob"]
+
+    # Same mtime but different size (coarse timestamps)
+    secretsfile.write("bob:{SHA}5en6G6MezRroT3XKqkdPOmY/BfQ=\nc:d:e\n")
+    os.utime(secretsfile.strpath, (mtime + 5, mtime + 5))
+    assert handler._load_htpasswd(secretsfile.strpath)["c"] == "d:e"
+
+
+def test_verify_pass_cached():
+    import emergency_git_server
+    from emergency_git_server import verify_pass_cached
+
+    saved = "$apr1$Zq3./xY$VexVSnzeojXGGlIyg4QWn/"
+    emergency_git_server._verified.clear()
+
+    with patch(
+        "emergency_git_server.verify_pass",
+        wraps=emergency_git_server.verify_pass
+    ) as m_vp:
+        with patch("emergency_git_server.monotonic", return_value=100.0):
+            assert verify_pass_cached(saved, "secret") is True
+            assert verify_pass_cached(saved, "secret") is True
+            assert verify_pass_cached(saved, "wrong") is False
+            assert m_vp.call_count == 2
+
+        later = 100.0 + emergency_git_server._verified.ttl
+        with patch("emergency_git_server.monotonic", return_value=later):
+            assert verify_pass_cached(saved, "secret") is True
+            assert m_vp.call_count == 3
+
+    assert not any("secret" in repr(k) for k in emergency_git_server._verified)
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="Auth is Linux only")
+def test_handle_auth_without_crypt(tmpdir):
+    import base64
+    from emergency_git_server import HTTPBackendHandler, HTTPStatus
+
+    secretsfile = tmpdir / "htpasswd"
+    secretsfile.write("carl:abJnggxhB/yWI\n")
+    handler = HTTPBackendHandler.__new__(HTTPBackendHandler)
+    for name in ("log_error", "log_exception", "send_error", "send_response",
+                 "send_header", "end_headers", "wfile"):
+        setattr(handler, name, Mock())
+    handler.auth_env = {}
+    handler.auth_dict = {
+        "/priv": {"secretsfile": secretsfile.strpath, "privaterepo": True}
+    }
+    handler.command = "GET"
+    handler.path = "/priv/repo.git/info/refs?service=git-upload-pack"
+    creds = base64.b64encode(b"carl:whatever").decode()
+    handler.headers = {"authorization": "Basic %s" % creds}
+
+    # DES entries can't be checked, so they must be refused, not skipped
+    with patch("emergency_git_server.crypt", None):
+        assert handler.handle_auth() is False
+    handler.send_error.assert_called_once_with(
+        HTTPStatus.UNAUTHORIZED, "No permission"
+    )
+    assert handler.log_error.called
+    assert "REMOTE_USER" not in handler.auth_env
+
+    # Unparseable secrets file fails closed
+    handler.send_error.reset_mock()
+    secretsfile.write("dave:$2y$05$abcdefghijklmnopqrstuv\n")
+    assert handler.handle_auth() is False
+    assert handler.send_error.call_args[0][0] == (
+        HTTPStatus.INTERNAL_SERVER_ERROR
+    )
+
+
+def test_copy_body():
+    from io import BytesIO
+    from emergency_git_server import HTTPBackendHandler
+
+    class Trickle(BytesIO):
+        def read(self, n=-1):
+            return BytesIO.read(self, min(n, 7))
+
+    handler = HTTPBackendHandler.__new__(HTTPBackendHandler)
+    handler.rfile = Trickle(b"x" * 100 + b"GET / HTTP/1.1")
+    dest = BytesIO()
+    assert handler.copy_body(dest, 100) == 0
+    assert dest.getvalue() == b"x" * 100
+    assert handler.rfile.read(3) == b"GET"
+
+    # Remainder discarded when destination goes away
+    dest = Mock(write=Mock(side_effect=OSError))
+    handler.rfile = Trickle(b"y" * 20)
+    assert handler.copy_body(dest, 30) == 10
+    assert dest.write.call_count == 1
+
+
+def test_get_base_env(monkeypatch):
+    from emergency_git_server import HTTPBackendHandler
+
+    monkeypatch.setattr(HTTPBackendHandler, "base_env", None)
+    monkeypatch.setenv("QUERY_STRING", "from_environ")
+    handler = HTTPBackendHandler.__new__(HTTPBackendHandler)
+    base_env = handler._get_base_env()
+    assert base_env["GATEWAY_INTERFACE"] == "CGI/1.1"
+    assert base_env["SCRIPT_NAME"] == "git-http-backend"
+    assert base_env["QUERY_STRING"] == "from_environ"
+    assert base_env["HTTP_COOKIE"] == ""
+
+    monkeypatch.setenv("QUERY_STRING", "changed")
+    assert handler._get_base_env() is base_env
+    assert base_env["QUERY_STRING"] == "from_environ"
+
+
+@pytest.mark.skipif(is_27, reason="Python 3 header parsing")
+def test_populate_envvars_headers(monkeypatch):
+    from io import BytesIO
+    from http.client import parse_headers
+    from emergency_git_server import HTTPBackendHandler
+
+    monkeypatch.setattr(HTTPBackendHandler, "base_env", None)
+    handler = HTTPBackendHandler.__new__(HTTPBackendHandler)
+    handler.headers = parse_headers(BytesIO(
+        b"Accept: a/b, c/d\r\n"
+        b"Accept: e/f,\r\n"
+        b"Cookie: x=1\r\n"
+        b"Cookie: y=2\r\n"
+        b"User-Agent: git/2.0\r\n"
+        b"Content-Length: 42\r\n"
+        b"\r\n"
+    ))
+    handler.git_env = {"PATH_INFO": "/repo.git/git-upload-pack"}
+    handler.auth_env = {}
+    handler.path = "/repo.git/git-upload-pack"
+    handler.command = "POST"
+    handler.client_address = ("127.0.0.1", 12345)
+    handler.server = Mock(
+        server_name="localhost", server_port=8000, cgi_env=None
+    )
+
+    env = handler._populate_envvars()
+    assert env["HTTP_ACCEPT"] == "a/b,c/d,e/f"
+    assert env["HTTP_COOKIE"] == "x=1, y=2"
+    assert env["HTTP_USER_AGENT"] == "git/2.0"
+    assert env["HTTP_REFERER"] == ""
+    assert env["CONTENT_LENGTH"] == "42"
+    assert env["CONTENT_TYPE"] == "text/plain"
+    assert env["SERVER_PORT"] == "8000"
+    assert handler.server.cgi_env["SERVER_NAME"] == "localhost"
+    assert handler.server.cgi_env["HTTP_COOKIE"] != env["HTTP_COOKIE"]
+
+
+def test_bounded_cache():
+    from emergency_git_server import BoundedCache
+
+    cache = BoundedCache(maxsize=2)
+    assert cache.lookup("a") is None
+    assert cache.lookup("a", "dflt") == "dflt"
+    assert cache.store("a", False) is False
+    assert cache.lookup("a", "dflt") is False  # falsy values are hits
+    cache.store("b", 2)
+    cache.store("c", 3)  # full, so start over
+    assert list(cache) == ["c"]
+
+    cache = BoundedCache(maxsize=10, ttl=5.0)
+    with patch("emergency_git_server.monotonic", return_value=100.0):
+        cache.store("a", 1)
+        assert cache.lookup("a") == 1
+    with patch("emergency_git_server.monotonic", return_value=105.0):
+        assert cache.lookup("a") is None
+        cache.store("a", 2)
+        assert cache.lookup("a") == 2
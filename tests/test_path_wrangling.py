@@ -49,6 +49,11 @@ import os
 import pytest
 from itertools import chain
 
+try:
+    from unittest.mock import patch
+except ImportError:  # 27
+    from mock import patch
+
 _data = {}
 
 
@@ -75,23 +80,18 @@ def pytest_generate_tests(metafunc):
 
 def make_parts(root, parts):
     assert type(root)().strpath.startswith("/tmp")
-    trunk = root
-    for component in chain.from_iterable(parts):
-        if not component:
-            continue
-        trunk = trunk / component
-        if not trunk.exists():
-            trunk.mkdir()
-        else:
-            assert trunk.isdir()
-            assert trunk.basename == "info"
-        if trunk.ext == ".git":
-            head = trunk / "HEAD"
-            head.write("")
-            info = trunk / "info"
-            info.mkdir()
-            refs = trunk / "refs" / "heads" / "master"
-            refs.ensure()
+    components = [c for c in chain.from_iterable(parts) if c]
+    repos = []
+    for index, component in enumerate(components):
+        if os.path.splitext(component)[1] == ".git":
+            # Path data may continue below a repo only by way of info/
+            assert components[index + 1:index + 2] in ([], ["info"])
+            repos.append(root.join(*components[:index + 1]))
+    root.join(*components).ensure(dir=True)
+    for repo in repos:
+        repo.join("HEAD").write("")
+        repo.join("info").ensure(dir=True)
+        repo.join("refs", "heads", "master").ensure()
 
 
 def test_determine_env_vars(path_data, tmpdir):
@@ -224,3 +224,96 @@ def test_dismember_target(tmpdir, gitroot, ns, extra, query):
     path = "/" + combined
     result = dismember_target(tmpdir.strpath, path)
     assert result == (gitroot, ns, repoplus.rstrip("/"), query)
+
+
+def test_is_repo_cached(tmpdir):
+    import emergency_git_server
+    from emergency_git_server import is_repo
+
+    repo = tmpdir / "repo.git"
+    repo.mkdir()
+
+    with patch("emergency_git_server.monotonic", return_value=100.0):
+        assert is_repo(repo.strpath) is False
+        (repo / "HEAD").write("")
+        assert is_repo(repo.strpath) is False  # stale
+
+    later = 100.0 + emergency_git_server._repo_probes.ttl
+    with patch("emergency_git_server.monotonic", return_value=later):
+        assert is_repo(repo.strpath) is True
+
+    # Creating a repo invalidates everything
+    new = tmpdir / "new.git"
+    assert is_repo(new.strpath) is False
+    emergency_git_server.create_repo_from_uri(new.strpath)
+    assert is_repo(new.strpath) is True
+
+
+def test_dismember_target_skips_exists_for_repos(tmpdir):
+    from emergency_git_server import dismember_target
+
+    repo = tmpdir / "grp" / "repo.git"
+    (repo / "refs" / "heads").ensure(dir=True)
+    (repo / "HEAD").write("")
+    target = "/grp/ns/repo.git/info/refs?service=git-upload-pack"
+    expected = ("grp", "ns", "repo.git/info/refs",
+                "?service=git-upload-pack")
+
+    assert dismember_target(tmpdir.strpath, target) == expected
+    with patch("os.path.exists", wraps=os.path.exists) as m_exists:
+        assert dismember_target(tmpdir.strpath, target) == expected
+    probed = [c[0][0] for c in m_exists.call_args_list]
+    assert repo.strpath not in probed
+
+
+def test_url_collapse_path_memoized():
+    from emergency_git_server import url_collapse_path
+
+    uri = "/foo/./bar.git/info/refs?service=git-upload-pack"
+    first = url_collapse_path(uri)
+    assert url_collapse_path(uri) is first
+    assert first == ("/foo/bar.git/info/refs", "", "?service=git-upload-pack")
+
+
+def test_is_empty_dir(tmpdir):
+    from emergency_git_server import is_empty_dir
+
+    assert is_empty_dir(tmpdir.strpath) is True
+    (tmpdir / ".hidden").write("")
+    assert is_empty_dir(tmpdir.strpath) is False
+
+
+@pytest.mark.parametrize("uri", [
+    "/", "", "/a/b", "a/b/", "/a/../b", "/a/./b/", "//a//b", "/a/b/..",
+    "/../../etc/passwd", "/%2e%2e/x", "/a%20b/c", "/a/b?x=1&y=/z",
+    "/a#frag/", "/a/b/?q", "/repo.git/info/refs?service=git-upload-pack",
+])
+def test_translate_path(tmpdir, monkeypatch, uri):
+    import sys
+    from emergency_git_server import translate_path
+
+    try:
+        from SimpleHTTPServer import SimpleHTTPRequestHandler
+    except ImportError:
+        from http.server import SimpleHTTPRequestHandler
+
+    # Upstream uses cwd before 3.7, self.directory after
+    if sys.version_info < (3, 7):
+        monkeypatch.chdir(tmpdir)
+    handler = SimpleHTTPRequestHandler.__new__(SimpleHTTPRequestHandler)
+    handler.directory = tmpdir.strpath
+
+    expected = SimpleHTTPRequestHandler.translate_path(handler, uri)
+    assert translate_path(tmpdir.strpath, uri) == expected
+
+
+def test_is_ghb_bound():
+    from emergency_git_server import is_ghb_bound
+
+    assert is_ghb_bound("GET", "/a/r.git/info/refs?service=git-upload-pack")
+    assert is_ghb_bound("GET", "/r.git/info/refs?service=git-receive-pack")
+    assert not is_ghb_bound("GET", "/r.git/info/refs")
+    assert not is_ghb_bound("GET", "/r.git/git-upload-pack")
+    assert is_ghb_bound("POST", "/a/r.git/git-upload-pack")
+    assert is_ghb_bound("POST", "/r.git/git-receive-pack")
+    assert not is_ghb_bound("POST", "/a/r.git")